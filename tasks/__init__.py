@@ -0,0 +1,2 @@
+# Python-реализации скриптов из ./tasks: worker.py вызывает их в процессе,
+# без запуска bash. Каждая run() возвращает (returncode, output).
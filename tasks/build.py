@@ -0,0 +1,9 @@
+# build.py — то же, что build.sh, но без fork/exec bash
+import time
+
+
+def run() -> tuple[int, str]:
+    lines = ["Build started..."]
+    time.sleep(1)
+    lines.append("Build OK")
+    return 0, "\n".join(lines) + "\n"
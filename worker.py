@@ -2,114 +2,493 @@
 # Требуемые переменные окружения в GitHub Actions:
 #   NOTION_TOKEN, NOTION_DATABASE_ID, OPENAI_API_KEY
 # Требуемые пакеты в requirements.txt:
-#   notion-client==2.2.1, python-dotenv==1.0.1, requests==2.32.3, openai==1.45.0 (SDK не обязателен)
+#   notion-client==2.2.1, python-dotenv==1.0.1, requests==2.32.3, openai==1.45.0 (SDK не обязателен),
+#   h2==4.1.0 и httpx==0.28.1 (HTTP/2-клиент для Notion), orjson==3.10.7 (не обязателен, ускоряет JSON)
 
-import os, json, shlex, subprocess, time, re
-from typing import Callable, List, Dict, Any
+import os, sys, json, time, threading, hashlib, random, logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Iterable, List, Dict, Any
+from urllib.parse import unquote
 
 from notion_client import Client
 from dotenv import load_dotenv
-import requests
+import httpx
+
+from tasks import build as task_build
+
+try:
+    import orjson
+    _loads = orjson.loads
+
+    def _dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:  # orjson не обязателен — падаем на stdlib
+    _loads = json.loads
+
+    def _dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
 
 # ---------- init ----------
 load_dotenv()
+# один обработчик на stdout: записи из разных потоков не склеиваются, ниже порога не форматируются
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s",
+    stream=sys.stdout,
+)
+log = logging.getLogger("worker")
+logging.getLogger("httpx").setLevel(logging.WARNING)   # иначе httpx пишет INFO на каждый запрос
 
 NOTION_TOKEN = os.environ["NOTION_TOKEN"]
 DB_ID = os.environ["NOTION_DATABASE_ID"]
 
-notion = Client(auth=NOTION_TOKEN)
+# notion_client работает поверх httpx — отдаём ему HTTP/2-клиент, чтобы параллельные
+# задачи мультиплексировали запросы в одном соединении с api.notion.com
+notion = Client(
+    auth=NOTION_TOKEN,
+    client=httpx.Client(http2=True, limits=httpx.Limits(max_connections=10)),
+)
+
+# HTTP-сессия для call_api и OpenAI: keep-alive вместо нового TCP+TLS на каждый запрос.
+# Ходит на разные хосты, поэтому без заголовков авторизации. Адаптер сам повторяет обрывы
+# соединения и 429/5xx с учётом Retry-After (POST по статусу urllib3 не повторяет).
+# requests импортируется лениво: в типичном запуске без эпиков и call_api он не нужен.
+@lru_cache(maxsize=1)
+def _http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    retry = Retry(
+        total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True, raise_on_status=False,
+    )
+    session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry))
+    return session
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
-# Белые списки
-ALLOWED_ACTIONS = {"run_script", "call_api", "codex_apply"}   # codex_apply сейчас отключен внутри
+# Белые списки (разрешённые action — ключи ACTIONS, см. ALLOWED_ACTIONS ниже)
 ALLOWED_SCRIPTS = {"build.sh", "sync_data.sh"}                # скрипты в ./tasks
 ALLOWED_URLS = {"https://httpbin.org/post"}                   # разрешённые call_api URL
 
+# Скрипты с Python-реализацией выполняются в процессе; остальные — через bash
+SCRIPT_IMPLS: Dict[str, Callable[[], tuple[int, str]]] = {"build.sh": task_build.run}
+SCRIPT_TIMEOUT = 300
+SCRIPT_OUTPUT_LINES = 200   # сколько последних строк вывода скрипта держим в памяти
+
+TASK_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "4"))   # сколько Ready-задач выполняется параллельно
+CREATE_CONCURRENCY = 8   # сколько страниц эпика создаётся параллельно
+RUNNING_DELAY = 0.5      # задачи быстрее этого (сек) не проходят через статус Running
+NOTION_RPS = 3           # средний лимит Notion API — 3 запроса/сек
+
+CACHE_DIR = ".cache"     # локальный кэш между запусками (в Actions сохраняется через actions/cache)
+# сколько секунд считаем схему БД свежей (меняется редко); устаревший кэш безопасен:
+# check_props и query_projected при расхождении перечитывают схему из Notion
+SCHEMA_TTL = 24 * 3600
+LLM_CACHE_TTL = 7 * 24 * 3600   # сколько хранится ответ LLM на одинаковый запрос
+
+WORKER_DEBUG = os.environ.get("WORKER_DEBUG") == "1"   # отладочный вывод (дамп схемы БД)
+
 # ---------- utils ----------
-def _retry(n: int = 5, delay: float = 0.8):
+def _is_retryable(e: Exception) -> bool:
+    # у APIResponseError есть status: повторяем только 429 и 5xx; сетевые ошибки и таймауты — всегда
+    status = getattr(e, "status", None)
+    return status is None or status == 429 or status >= 500
+
+def _is_retryable_create(e: Exception) -> bool:
+    # создание не идемпотентно: после таймаута или 5xx страница могла уже появиться.
+    # Повторяем только 429 и ошибку соединения (запрос до сервера не дошёл)
+    return getattr(e, "status", None) == 429 or isinstance(e, httpx.ConnectError)
+
+def _retry_after(e: Exception) -> float | None:
+    # на 429 Notion присылает Retry-After (в секундах)
+    if getattr(e, "status", None) != 429:
+        return None
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def _retry(n: int = 5, delay: float = 0.8, max_delay: float = 30.0, bucket=None,
+           retry_on: Callable[[Exception], bool] = _is_retryable):
     def deco(fn: Callable):
         def wrap(*a, **kw):
-            last = None
             for i in range(1, n + 1):
+                if bucket is not None:
+                    bucket.acquire()
                 try:
-                    return fn(*a, **kw)
+                    res = fn(*a, **kw)
                 except Exception as e:
-                    last = e
-                    print(f"[RETRY] {fn.__name__} failed ({i}/{n}): {e}")
-                    time.sleep(delay * i)
-            raise last
+                    if bucket is not None and getattr(e, "status", None) == 429:
+                        bucket.throttle()
+                    if i == n or not retry_on(e):
+                        raise
+                    log.warning("retry %s failed (%d/%d): %s", fn.__name__, i, n, e)
+                    pause = _retry_after(e)
+                    if pause is None:
+                        # экспоненциальная пауза плюс джиттер до delay, чтобы параллельные ретраи не совпадали
+                        pause = min(max_delay, delay * 2 ** (i - 1) + random.uniform(0, delay))
+                    time.sleep(pause)
+                else:
+                    if bucket is not None:
+                        bucket.relax()
+                    return res
         return wrap
     return deco
 
-@_retry()
+class TokenBucket:
+    """Ограничитель частоты: до capacity запросов подряд, дальше rate запросов/сек.
+
+    Скорость адаптивная: на 429 делится пополам (throttle), на каждом успехе
+    понемногу возвращается к исходной (relax) — тормозим только когда API просит.
+    """
+
+    def __init__(self, rate: float, capacity: float, min_rate: float = 0.2, step: float = 0.1):
+        self.max_rate = rate
+        self.min_rate = min_rate
+        self.step = step
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def relax(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.step)
+
+# общий для всех потоков лимит на вызовы Notion
+_NOTION_BUCKET = TokenBucket(rate=NOTION_RPS, capacity=NOTION_RPS)
+
+@_retry(bucket=_NOTION_BUCKET)
 def notion_update_page(page_id, properties):
     return notion.pages.update(page_id=page_id, properties=properties)
 
-@_retry()
+@_retry(bucket=_NOTION_BUCKET)
 def notion_append_block(block_id, children):
     return notion.blocks.children.append(block_id=block_id, children=children)
 
+@_retry(bucket=_NOTION_BUCKET, retry_on=_is_retryable_create)
+def notion_create_page(properties):
+    return notion.pages.create(parent={"database_id": DB_ID}, properties=properties)
+
+@_retry(bucket=_NOTION_BUCKET)
+def notion_query_db(**kwargs):
+    return notion.databases.query(database_id=DB_ID, **kwargs)
+
+@_retry(bucket=_NOTION_BUCKET)
+def notion_retrieve_db():
+    return notion.databases.retrieve(DB_ID)
+
+def _cache_read(path: str, ttl: float) -> Any | None:
+    """Прочитать JSON из кэша, если файл моложе ttl секунд; иначе None."""
+    try:
+        if os.path.getmtime(path) > time.time() - ttl:
+            with open(path, "rb") as f:
+                return _loads(f.read())
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _cache_write(path: str, obj: Any):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(_dumps(obj))
+    except OSError as e:
+        log.warning("cache write failed (%s): %s", path, e)
+
+def _schema_cache_path() -> str:
+    key = hashlib.blake2b(DB_ID.encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"notion_schema_{key}.json")
+
+_SCHEMA: dict | None = None
+_SCHEMA_FRESH = False    # схема в этом процессе уже перечитана из Notion
+_SCHEMA_LOCK = threading.Lock()
+
+def get_db_schema(refresh: bool = False) -> dict:
+    """Схема БД из локального кэша, если он моложе SCHEMA_TTL, иначе — из Notion.
+
+    В пределах процесса схема читается один раз (её запрашивают из разных потоков);
+    refresh=True перечитывает её из Notion, но не чаще раза за процесс.
+    """
+    global _SCHEMA, _SCHEMA_FRESH
+    with _SCHEMA_LOCK:
+        if refresh and _SCHEMA_FRESH:
+            refresh = False
+        if _SCHEMA is None or refresh:
+            path = _schema_cache_path()
+            db = None if refresh else _cache_read(path, SCHEMA_TTL)
+            if db is None:
+                db = notion_retrieve_db()
+                _cache_write(path, db)
+                _SCHEMA_FRESH = True
+            _SCHEMA = db
+        return _SCHEMA
+
+def _schema_mismatches(props: Dict[str, Any], schema: dict) -> List[str]:
+    known = schema.get("properties", {})
+    # значение свойства — {"<type>": ...}; тип должен совпасть с типом в схеме
+    return [name for name, value in props.items()
+            if known.get(name, {}).get("type") != next(iter(value), None)]
+
+def check_props(props: Dict[str, Any]) -> Dict[str, Any]:
+    """Сверить свойства со схемой БД до отправки и выкинуть неизвестные/не того типа.
+
+    Иначе Notion отвергает весь запрос (400) и статус не записывается вовсе.
+    Если схема недоступна — свойства уходят как есть.
+    """
+    try:
+        bad = _schema_mismatches(props, get_db_schema())
+        if bad:
+            # схема могла устареть в кэше — перед отбрасыванием сверяемся со свежей
+            bad = _schema_mismatches(props, get_db_schema(refresh=True))
+    except Exception as e:
+        log.warning("check_props: schema unavailable: %s", e)
+        return props
+    if not bad:
+        return props
+    log.warning("dropping properties missing from DB schema or of wrong type: %s", ", ".join(bad))
+    return {k: v for k, v in props.items() if k not in bad}
+
+def property_ids(names: Iterable[str]) -> List[str] | None:
+    """ID свойств по именам для filter_properties; None — без проекции (схема недоступна)."""
+    try:
+        props = get_db_schema().get("properties", {})
+    except Exception as e:
+        log.warning("property_ids: schema unavailable: %s", e)
+        return None
+    # в схеме id уже URL-кодированы, а httpx кодирует query сам
+    ids = [unquote(props[n]["id"]) for n in names if props.get(n, {}).get("id")]
+    return ids or None
+
+def _projection(names: Iterable[str]) -> dict:
+    ids = property_ids(names)
+    return {"filter_properties": ids} if ids else {}
+
+def query_projected(query: Callable[..., List[dict]], names: Iterable[str]) -> List[dict]:
+    """Выполнить query(**kwargs) с filter_properties по names.
+
+    id берутся из кэша схемы и могут устареть: если запрос упал или в страницах
+    нет какого-то из свойств, перечитываем схему и повторяем один раз без проекции.
+    """
+    names = tuple(names)
+    proj = _projection(names)
+    if not proj:
+        return query()
+    try:
+        pages = query(**proj)
+    except Exception as e:
+        log.warning("projected query failed, retrying without projection: %s", e)
+    else:
+        if all(set(names) <= p.get("properties", {}).keys() for p in pages):
+            return pages
+        log.warning("projected query lost properties, retrying without projection")
+    try:
+        get_db_schema(refresh=True)
+    except Exception as e:
+        log.warning("schema refresh failed: %s", e)
+    return query()
+
 def debug_dump_db_schema():
     try:
-        db = notion.databases.retrieve(DB_ID)
-        print("=== DB PROPERTIES ===")
-        for name, meta in db.get("properties", {}).items():
-            print(f"- {name}: {meta.get('type')}")
-        print("=====================")
+        db = get_db_schema()
+        lines = [f"- {name}: {meta.get('type')}" for name, meta in db.get("properties", {}).items()]
+        log.info("=== DB PROPERTIES ===\n%s", "\n".join(lines))
     except Exception as e:
-        print(f"[WARN] debug_dump_db_schema failed: {e}")
+        log.warning("debug_dump_db_schema failed: %s", e)
 
 def _prop(props: dict, name: str, default=None):
     return props.get(name) or default
 
 # ---------- status/logs ----------
+# Обновления статусов копятся в очереди и уходят пачкой в flush_updates():
+# на страницу — один pages.update и один blocks.children.append за сброс.
+# Блок с логом пишется только для итоговых статусов: лог промежуточного уже лежит в Logs.
+TERMINAL_STATUSES = {"Done", "Failed"}
+
+@dataclass
+class PendingUpdate:
+    page_id: str
+    props: Dict[str, Any] = field(default_factory=dict)
+    blocks: List[dict] = field(default_factory=list)
+
+_PENDING: deque[PendingUpdate] = deque()
+_PENDING_LOCK = threading.Lock()
+
 def set_status(page_id: str, status: str, logs: str | None = None):
-    print(f"set_status[{status}] …")
+    log.info("set_status[%s] %s", status, page_id)
     props = {"Status": {"select": {"name": status}}}
+    blocks = []
     snippet = (str(logs)[:1800] if logs else None)
     if snippet:
         props["Logs"] = {"rich_text": [{"type": "text", "text": {"content": snippet}}]}
-        props["LogsPlain"] = {"rich_text": [{"type": "text", "text": {"content": snippet}}]}
-    try:
-        notion_update_page(page_id, props)
-    except Exception as e:
-        print(f"[ERR] pages.update failed: {e}")
-    if snippet:
+    if snippet and status in TERMINAL_STATUSES:
+        blocks.append({
+            "object": "block",
+            "type": "paragraph",
+            "paragraph": {"rich_text": [{"type": "text", "text": {"content": snippet}}]}
+        })
+    with _PENDING_LOCK:
+        _PENDING.append(PendingUpdate(page_id, props, blocks))
+
+def flush_updates(page_id: str | None = None):
+    """Отправить накопленные обновления, сгруппировав их по странице.
+
+    page_id ограничивает сброс одной страницей (задачи идут в разных потоках).
+    """
+    merged: Dict[str, PendingUpdate] = {}
+    with _PENDING_LOCK:
+        rest: deque[PendingUpdate] = deque()
+        while _PENDING:
+            u = _PENDING.popleft()
+            if page_id is not None and u.page_id != page_id:
+                rest.append(u)
+                continue
+            m = merged.setdefault(u.page_id, PendingUpdate(u.page_id))
+            m.props.update(u.props)
+            m.blocks.extend(u.blocks)
+        _PENDING.extend(rest)
+    for pid, u in merged.items():
+        if u.props:
+            try:
+                props = check_props(u.props)
+                if props:
+                    notion_update_page(pid, props)
+            except Exception as e:
+                log.error("pages.update failed: %s", e)
+        if not u.blocks:
+            continue
         try:
-            notion_append_block(page_id, [{
-                "object": "block",
-                "type": "paragraph",
-                "paragraph": {"rich_text": [{"type": "text", "text": {"content": snippet}}]}
-            }])
+            notion_append_block(pid, u.blocks)
         except Exception as e:
-            print(f"[WARN] blocks.append failed: {e}")
+            log.warning("blocks.append failed: %s", e)
 
 # ---------- actions ----------
-def fetch_ready_tasks():
-    print("Querying Ready tasks…")
-    res = notion.databases.query(
-        database_id=DB_ID,
+def query_all(**kwargs) -> List[dict]:
+    """databases.query с проходом по всем страницам курсора (по 100 записей)."""
+    results: List[dict] = []
+    cursor = None
+    while True:
+        extra = {"start_cursor": cursor} if cursor else {}
+        res = notion_query_db(page_size=100, **kwargs, **extra)
+        results += res.get("results", [])
+        if not res.get("has_more"):
+            return results
+        cursor = res.get("next_cursor")
+
+@dataclass
+class TaskFields:
+    """Поля задачи, нужные handle_task, — вытаскиваются из страницы один раз при выборке."""
+    page_id: str
+    title: str
+    action: str | None
+    payload_txt: str
+
+def extract_task_fields(page: dict) -> TaskFields:
+    props = page["properties"]
+    title = props["Name"]["title"][0]["plain_text"] if props["Name"]["title"] else "(no title)"
+    action = props["Action"]["select"]["name"] if props.get("Action") and props["Action"]["select"] else None
+    payload_txt = "".join(t["plain_text"] for t in props.get("Payload", {}).get("rich_text", [])) or "{}"
+    return TaskFields(page["id"], title, action, payload_txt)
+
+# свойства, которые реально читаются из выборок; остальные Notion не присылает
+TASK_PROPERTIES = ("Name", "Action", "Payload")
+EPIC_PROPERTIES = ("Name", "Description")
+
+def fetch_ready_tasks() -> List[TaskFields]:
+    log.info("Querying Ready tasks…")
+    # порядок Priority → last_edited_time задаёт сервер и он сохраняется между страницами курсора
+    results = query_projected(lambda **proj: query_all(
         filter={"property": "Status", "select": {"equals": "Ready"}},
         sorts=[
             {"property": "Priority", "direction": "ascending"},
             {"timestamp": "last_edited_time", "direction": "ascending"},
         ],
-        page_size=20,
-    )
-    results = res.get("results", [])
-    print(f"Found {len(results)} ready task(s).")
-    return results
+        **proj,
+    ), TASK_PROPERTIES)
+    log.info("Found %d ready task(s).", len(results))
+    return [extract_task_fields(p) for p in results]
 
 def safe_run(cmd: str | None):
-    parts = shlex.split(cmd or "")
-    if len(parts) != 1:
+    cmd = (cmd or "").strip()
+    if not cmd or any(c.isspace() for c in cmd):
         raise RuntimeError("Only single command name allowed in Payload.cmd")
-    name = os.path.basename(parts[0])
+    name = os.path.basename(cmd)
     if name not in ALLOWED_SCRIPTS:
         raise RuntimeError(f"Script '{name}' not allowed")
-    print(f"safe_run: {name}")
-    proc = subprocess.run(["/bin/bash", f"./tasks/{name}"], capture_output=True, text=True, timeout=300)
-    out = (proc.stdout or "") + (proc.stderr or "")
-    print(f"safe_run exit code: {proc.returncode}")
+    fn = SCRIPT_IMPLS.get(name)
+    if fn is not None:
+        log.info("safe_run: %s (in-process)", name)
+        ex = ThreadPoolExecutor(max_workers=1)
+        try:
+            # по таймауту поток не прервать — задача падает, поток доживает сам
+            code, out = ex.submit(fn).result(timeout=SCRIPT_TIMEOUT)
+        except FutureTimeoutError:
+            raise RuntimeError(f"Script '{name}' timed out after {SCRIPT_TIMEOUT}s") from None
+        finally:
+            ex.shutdown(wait=False)
+        log.info("safe_run exit code: %s", code)
+        return code, out
+    import signal, subprocess  # нужны только для скриптов без Python-реализации
+
+    log.info("safe_run: %s", name)
+    proc = subprocess.Popen(
+        ["/bin/bash", f"./tasks/{name}"],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+        errors="replace",  # один битый байт в логе не должен ронять задачу
+        start_new_session=True,  # своя сессия: параллельные скрипты не делят терминал воркера
+    )
+    killed = threading.Event()
+
+    def kill():
+        # убиваем всю группу: иначе дочерние процессы скрипта держат pipe открытым
+        killed.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    timer = threading.Timer(SCRIPT_TIMEOUT, kill)
+    timer.start()
+    try:
+        # читаем построчно и храним только хвост — в лог задачи всё равно уходит ~1800 символов
+        tail = deque(proc.stdout, maxlen=SCRIPT_OUTPUT_LINES)
+        proc.wait()
+    except BaseException:
+        # при ошибке чтения скрипт не должен остаться жить в своей сессии
+        kill()
+        proc.wait()
+        raise
+    finally:
+        timer.cancel()
+        proc.stdout.close()
+    if killed.is_set():
+        raise RuntimeError(f"Script '{name}' timed out after {SCRIPT_TIMEOUT}s")
+    out = "".join(tail)[-1800:]
+    log.info("safe_run exit code: %s", proc.returncode)
     return proc.returncode, out
 
 def call_api(payload: dict):
@@ -118,51 +497,88 @@ def call_api(payload: dict):
     body = payload.get("body")
     if not url or url not in ALLOWED_URLS:
         raise RuntimeError("URL not allowed")
-    print(f"call_api: {url} {method}")
-    r = requests.request(method, url, json=body, timeout=20)
+    log.info("call_api: %s %s", url, method)
+    # тело кодируем сами (_dumps), минуя json.dumps внутри requests
+    if body is None:
+        r = _http_session().request(method, url, timeout=20)
+    else:
+        r = _http_session().request(method, url, data=_dumps(body).encode(), headers=_JSON_HEADERS, timeout=20)
     text = f"{r.status_code} {r.text[:1500]}"
     return r.status_code, text
 
-def codex_apply(payload: dict):
-    # CLI отключена — фейлим с понятной причиной, чтобы не висло
-    raise RuntimeError("codex_apply disabled (Codex CLI not installed)")
-
-def handle_task(page: dict):
-    page_id = page["id"]
-    title = page["properties"]["Name"]["title"][0]["plain_text"] if page["properties"]["Name"]["title"] else "(no title)"
-    props = page["properties"]
-    action = props["Action"]["select"]["name"] if props.get("Action") and props["Action"]["select"] else None
-    payload_txt = "".join([t["plain_text"] for t in props.get("Payload", {}).get("rich_text", [])]) or "{}"
-    print(f"Handling: {title} [{page_id}] action={action} payload={payload_txt}")
+# action → обработчик(payload) -> (code, out); новое действие — новая запись здесь
+ACTIONS: Dict[str, Callable[[dict], tuple]] = {
+    "run_script": lambda p: safe_run(p.get("cmd")),
+    "call_api": call_api,
+}
+ALLOWED_ACTIONS = frozenset(ACTIONS)
 
+@lru_cache(maxsize=256)
+def _parse_payload(payload_txt: str) -> dict:
+    # кэш по тексту Payload: одинаковые payload'ы разбираются один раз; результат только читаем
     try:
-        payload = json.loads(payload_txt)
+        payload = _loads(payload_txt)
     except Exception:
-        payload = {}
-
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+def validate_task(action: str | None, payload: dict) -> str | None:
+    """Дешёвая проверка по allow-листам до запуска; возвращает причину отказа или None."""
+    if action not in ALLOWED_ACTIONS:
+        return f"Unknown or not allowed action: {action}"
+    if action == "run_script":
+        name = os.path.basename(str(payload.get("cmd") or "").strip())
+        if name not in ALLOWED_SCRIPTS:
+            return f"Script '{name}' not allowed"
+    elif action == "call_api":
+        url = payload.get("url")
+        # url из Payload может оказаться списком/объектом — такие в set не проверить
+        if not isinstance(url, str) or url not in ALLOWED_URLS:
+            return "URL not allowed"
+    return None
+
+def _mark_running(page_id: str):
     set_status(page_id, "Running")
+    flush_updates(page_id)
+
+def handle_task(task: TaskFields):
+    page_id, action = task.page_id, task.action
+    log.info("Handling: %s [%s] action=%s", task.title, page_id, action)
+    log.debug("payload=%s", task.payload_txt)
+
+    payload = _parse_payload(task.payload_txt)
+
+    # заведомо невалидные задачи сразу в Failed, без промежуточного Running
+    error = validate_task(action, payload)
+    if error:
+        set_status(page_id, "Failed", f"Invalid payload: {error}")
+        flush_updates(page_id)
+        return
+
+    # Running пишем, только если действие не уложилось в RUNNING_DELAY:
+    # быстрые задачи сразу получают итоговый статус — на один запрос к Notion меньше
+    running = threading.Timer(RUNNING_DELAY, _mark_running, args=(page_id,))
+    running.start()
     try:
-        if action == "run_script":
-            code, out = safe_run(payload.get("cmd"))
-        elif action == "call_api":
-            code, out = call_api(payload)
-        elif action == "codex_apply":
-            code, out = codex_apply(payload)
-        else:
-            raise RuntimeError(f"Unknown or not allowed action: {action}")
+        # неизвестные action уже отсеяны validate_task
+        code, out = ACTIONS[action](payload)
 
         if (isinstance(code, int) and code == 0) or (isinstance(code, int) and 200 <= code < 300):
-            set_status(page_id, "Done", out)
+            status = "Done"
         else:
-            set_status(page_id, "Failed", out)
+            status = "Failed"
     except Exception as e:
-        set_status(page_id, "Failed", f"Error: {e}")
+        status, out = "Failed", f"Error: {e}"
+    # если Running уже отправляется — дождаться, чтобы итоговый статус лёг после него
+    running.cancel()
+    running.join()
+    set_status(page_id, status, out)
+    flush_updates(page_id)
 
 # ---------- EPIC: detect & decompose ----------
 def fetch_ready_epics() -> List[dict]:
-    print("Querying Ready epics…")
-    res = notion.databases.query(
-        database_id=DB_ID,
+    log.info("Querying Ready epics…")
+    results = query_projected(lambda **proj: notion_query_db(
         filter={
             "and": [
                 {"property": "Type", "select": {"equals": "Epic"}},
@@ -171,15 +587,18 @@ def fetch_ready_epics() -> List[dict]:
         },
         sorts=[{"timestamp": "last_edited_time", "direction": "ascending"}],
         page_size=3,
-    )
-    results = res.get("results", [])
-    print(f"Found {len(results)} ready epic(s).")
+        **proj,
+    ).get("results", []), EPIC_PROPERTIES)
+    log.info("Found %d ready epic(s).", len(results))
     return results
 
-EPIC_PROMPT = """Ты — помощник по управлению задачами. Получишь описание большой цели (эпика).
-Сформируй список атомарных задач в JSON-массиве (без пояснений вокруг), каждая задача — объект с полями:
+# Системный промпт неизменен байт-в-байт между вызовами (описание эпика идёт отдельным
+# user-сообщением), чтобы общий префикс попадал в prompt caching OpenAI.
+EPIC_PROMPT = """You generate only valid JSON objects.
+Ты — помощник по управлению задачами. Следующим сообщением получишь описание большой цели (эпика).
+Сформируй список атомарных задач в JSON-объекте {"tasks": [...]}, каждая задача — объект с полями:
 - title: кратко-глаголом
-- action: одно из ["run_script","call_api"]  # не используй codex_apply
+- action: одно из ["run_script","call_api"]
 - payload: минимальный JSON под действие (для run_script: {"cmd":"build.sh"}; для call_api: {"url":"https://httpbin.org/post","method":"POST","body":{...}})
 - priority: целое число 1..N (1 — самый высокий)
 
@@ -187,162 +606,242 @@ EPIC_PROMPT = """Ты — помощник по управлению задач
 - 8–20 задач, 1 действие = 1 задача.
 - Не добавляй секреты. URL — только из allow-list: https://httpbin.org/post
 - Для сборки/проверки используй run_script с существующим build.sh
-- Ответ — ТОЛЬКО JSON-массив без текста до/после.
+- Ответ — ТОЛЬКО JSON-объект {"tasks": [...]} без текста до/после."""
+
+# Правила нормализации задач из ответа LLM — собраны один раз при импорте
+EPIC_ACTIONS = ALLOWED_ACTIONS
+EPIC_MAX_TASKS = 25
+DEFAULT_SCRIPT = "build.sh"
+DEFAULT_URL = "https://httpbin.org/post"
+
+def _normalize_epic_task(item: Any, default_priority: int) -> Dict[str, Any] | None:
+    """Привести элемент ответа LLM к задаче под allow-листы; None — элемент отбрасывается."""
+    if not isinstance(item, dict):
+        return None
+    title = str(item.get("title") or "").strip()[:180]
+    action = str(item.get("action") or "").strip()
+    if not title or action not in EPIC_ACTIONS:
+        return None
+    pl = item.get("payload")
+    if not isinstance(pl, dict):
+        pl = {}
+    try:
+        priority = int(item.get("priority") or default_priority)
+    except (TypeError, ValueError):
+        priority = default_priority
+
+    if action == "run_script":
+        cmd = str(pl.get("cmd") or DEFAULT_SCRIPT)
+        if cmd not in ALLOWED_SCRIPTS:
+            cmd = DEFAULT_SCRIPT
+        pl = {"cmd": cmd}
+    else:
+        url = str(pl.get("url") or DEFAULT_URL)
+        if url not in ALLOWED_URLS:
+            url = DEFAULT_URL
+        method = str(pl.get("method") or "POST").upper()
+        body = pl.get("body") or {"ping": "ok"}
+        pl = {"url": url, "method": method, "body": body}
+
+    return {
+        "title": title,
+        "action": action,
+        "payload": pl,
+        "priority": max(1, min(999, priority))
+    }
 
-Описание эпика:
-"""
+class _JsonEndTracker:
+    """Следит за потоком текста и сообщает, когда первый JSON-массив/объект закрылся."""
+
+    def __init__(self):
+        self.depth = 0
+        self.started = False
+        self.in_str = False
+        self.esc = False
+
+    def feed(self, text: str) -> bool:
+        for ch in text:
+            if self.in_str:
+                if self.esc:
+                    self.esc = False
+                elif ch == "\\":
+                    self.esc = True
+                elif ch == '"':
+                    self.in_str = False
+            elif ch == '"':
+                self.in_str = self.started
+            elif ch in "[{":
+                self.depth += 1
+                self.started = True
+            elif ch in "]}" and self.started:
+                self.depth -= 1
+                if self.depth == 0:
+                    return True
+        return False
+
+def _stream_chat_content(url: str, headers: dict, payload: dict) -> str:
+    """Собрать content из SSE-потока Chat Completions.
+
+    Чтение обрывается, как только JSON в ответе закрылся — хвост генерации не ждём.
+    """
+    parts: List[str] = []
+    tracker = _JsonEndTracker()
+    with _http_session().post(url, headers=headers, data=_dumps(payload).encode(), timeout=90, stream=True) as r:
+        if not r.ok:
+            raise RuntimeError(f"OpenAI API error: {r.status_code} {r.text[:400]}")
+        for raw in r.iter_lines():
+            line = raw.decode("utf-8")
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            choices = _loads(data).get("choices") or []
+            delta = (choices[0].get("delta") or {}).get("content") if choices else None
+            if not delta:
+                continue
+            parts.append(delta)
+            if tracker.feed(delta):
+                break
+    return "".join(parts).strip()
+
+def _llm_cache_path(payload: dict) -> str:
+    # ключ — весь запрос (модель, промпт, параметры): другой промпт или модель — другой ключ
+    # payload собирается в фиксированном порядке ключей, так что _dumps детерминирован
+    key = hashlib.sha256(_dumps(payload).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, "llm", f"{key}.json")
 
 def llm_decompose_epic(description: str) -> List[Dict[str, Any]]:
-    # читаем ключ "на лету", логируем наличие
-    key = os.environ.get("OPENAI_API_KEY")
-    print("LLM: OPENAI key present:", "yes" if bool(key) else "no")
-    if not key:
-        raise RuntimeError("OPENAI_API_KEY not set (LLM unavailable)")
-
-    prompt = EPIC_PROMPT + description.strip()
-
-    # Прямой HTTP-вызов Chat Completions
-    url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
     payload = {
         "model": "gpt-4o-mini",
         "messages": [
-            {"role": "system", "content": "You generate only valid JSON arrays."},
-            {"role": "user", "content": prompt},
+            {"role": "system", "content": EPIC_PROMPT},
+            {"role": "user", "content": description.strip()},
         ],
         "temperature": 0.2,
         "max_tokens": 1200,
+        # JSON mode: модель отдаёт чистый JSON-объект, без ``` и текста вокруг
+        "response_format": {"type": "json_object"},
+        "stream": True,
     }
 
-    r = requests.post(url, headers=headers, json=payload, timeout=90)
-    if not r.ok:
-        raise RuntimeError(f"OpenAI API error: {r.status_code} {r.text[:400]}")
-
-    # ---- парсим ответ: срезаем ```json … ``` если LLM так вернул
-    content = r.json()["choices"][0]["message"]["content"].strip()
-    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", content, re.DOTALL | re.IGNORECASE)
-    if fenced:
-        content = fenced.group(1).strip()
+    # тот же эпик (после Failed → Ready) берём из кэша, не дёргая LLM
+    cache_path = _llm_cache_path(payload)
+    cached = _cache_read(cache_path, LLM_CACHE_TTL)
+    if cached is not None:
+        log.info("LLM: cache hit")
+        raw = cached["content"]
     else:
-        m = re.search(r"\[\s*{.*}\s*\]", content, re.DOTALL)
-        if m:
-            content = m.group(0).strip()
+        # читаем ключ "на лету", логируем наличие
+        key = os.environ.get("OPENAI_API_KEY")
+        log.info("LLM: OPENAI key present: %s", "yes" if key else "no")
+        if not key:
+            raise RuntimeError("OPENAI_API_KEY not set (LLM unavailable)")
+
+        # Прямой HTTP-вызов Chat Completions
+        url = "https://api.openai.com/v1/chat/completions"
+        headers = {
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            "Accept": "text/event-stream",
+        }
+        raw = _stream_chat_content(url, headers, payload)
 
+    # ---- парсим ответ: {"tasks": [...]}
     try:
-        data = json.loads(content)
+        data = _loads(raw)
+        data = data.get("tasks") if isinstance(data, dict) else None
         if not isinstance(data, list):
-            raise ValueError("Expected a JSON array")
+            raise ValueError('Expected {"tasks": [...]}')
     except Exception as e:
-        raise RuntimeError(f"LLM JSON parse error: {e}  RAW={content[:400]}")
+        raise RuntimeError(f"LLM JSON parse error: {e}  RAW={raw[:400]}")
 
     # валидация под allow-листы
     tasks: List[Dict[str, Any]] = []
-    p = 1
-    for item in data[:25]:
-        title = str(item.get("title") or "").strip()[:180]
-        action = (item.get("action") or "").strip()
-        pl = item.get("payload") or {}
-        priority = int(item.get("priority") or p)
-        if not title or action not in {"run_script", "call_api"}:
-            continue
-
-        if action == "run_script":
-            cmd = str(pl.get("cmd") or "build.sh")
-            if cmd not in ALLOWED_SCRIPTS:
-                cmd = "build.sh"
-            pl = {"cmd": cmd}
-        else:
-            url2 = str(pl.get("url") or "https://httpbin.org/post")
-            if url2 not in ALLOWED_URLS:
-                url2 = "https://httpbin.org/post"
-            method = (pl.get("method") or "POST").upper()
-            body = pl.get("body") or {"ping": "ok"}
-            pl = {"url": url2, "method": method, "body": body}
-
-        tasks.append({
-            "title": title,
-            "action": action,
-            "payload": pl,
-            "priority": max(1, min(999, priority))
-        })
-        p += 1
+    for item in data[:EPIC_MAX_TASKS]:
+        task = _normalize_epic_task(item, len(tasks) + 1)
+        if task:
+            tasks.append(task)
 
     if len(tasks) < 5:
         raise RuntimeError("Too few tasks after validation")
 
+    # в кэш попадает только ответ, прошедший разбор и валидацию
+    if cached is None:
+        _cache_write(cache_path, {"content": raw})
     return tasks
 
+# неизменные свойства новых задач эпика — собираются один раз
+_NEW_TASK_TYPE = {"select": {"name": "Task"}}
+_NEW_TASK_STATUS = {"select": {"name": "Draft"}}
+
 def create_tasks_in_notion(tasks: List[Dict[str, Any]]) -> int:
-    headers = {
-        "Authorization": f"Bearer {NOTION_TOKEN}",
-        "Notion-Version": "2022-06-28",
-        "Content-Type": "application/json"
-    }
-    created = 0
-    for t in tasks:
+    def create(t: Dict[str, Any]) -> bool:
         properties = {
             "Name": {"title": [{"text": {"content": t["title"]}}]},
-            "Type": {"select": {"name": "Task"}},
-            "Status": {"select": {"name": "Draft"}},
+            "Type": _NEW_TASK_TYPE,
+            "Status": _NEW_TASK_STATUS,
             "Action": {"select": {"name": t["action"]}},
-            "Payload": {"rich_text": [{"text": {"content": json.dumps(t["payload"], ensure_ascii=False)}}]},
+            "Payload": {"rich_text": [{"text": {"content": _dumps(t["payload"])}}]},
             "Priority": {"number": t["priority"]},
         }
-        r = requests.post(
-            "https://api.notion.com/v1/pages",
-            headers=headers,
-            json={"parent": {"database_id": DB_ID}, "properties": properties},
-            timeout=20
-        )
-        if r.ok:
-            created += 1
-        else:
-            print(f"[ERR] create page failed: {r.status_code} {r.text[:300]}")
-    return created
+        try:
+            notion_create_page(check_props(properties))
+            return True
+        except Exception as e:
+            log.error("create page failed: %s", e)
+            return False
+
+    # страницы независимы — создаём параллельно, частоту держит _NOTION_BUCKET
+    with ThreadPoolExecutor(max_workers=CREATE_CONCURRENCY) as ex:
+        return sum(ex.map(create, tasks))
 
 def process_epics():
     epics = fetch_ready_epics()
     for epic in epics:
         epic_id = epic["id"]
         name = epic["properties"]["Name"]["title"][0]["plain_text"] if epic["properties"]["Name"]["title"] else "Epic"
-        desc = "".join([t["plain_text"] for t in epic["properties"].get("Description", {}).get("rich_text", [])]).strip()
-        print(f"Epic: {name} [{epic_id}] — decompose")
+        desc = "".join(t["plain_text"] for t in epic["properties"].get("Description", {}).get("rich_text", [])).strip()
+        log.info("Epic: %s [%s] — decompose", name, epic_id)
         if not desc:
             set_status(epic_id, "Failed", "Epic has empty Description")
+            flush_updates(epic_id)
             continue
         set_status(epic_id, "Running", "Decomposing epic into tasks...")
+        flush_updates(epic_id)
         try:
             tasks = llm_decompose_epic(desc)
             n = create_tasks_in_notion(tasks)
             set_status(epic_id, "Done", f"Created {n} task(s) from epic")
         except Exception as e:
             set_status(epic_id, "Failed", f"Epic decomposition failed: {e}")
+        flush_updates(epic_id)
 
 # ---------- main ----------
 def main():
-    print("Starting worker…")
-    print(f"DB_ID: {DB_ID}")
-    print(f"OPENAI_API_KEY present: {'yes' if bool(os.environ.get('OPENAI_API_KEY')) else 'no'}")
-    debug_dump_db_schema()
-
-    # 1) сначала обработать эпики (если есть)
-    try:
-        process_epics()
-    except Exception as e:
-        print(f"[WARN] process_epics failed: {e}")
+    log.info("Starting worker…")
+    log.info("DB_ID: %s", DB_ID)
+    log.info("OPENAI_API_KEY present: %s", "yes" if os.environ.get("OPENAI_API_KEY") else "no")
+    # дамп схемы — только для отладки (WORKER_DEBUG=1); тянем его в фоне, пока обрабатываются эпики.
+    # Ready-задачи запрашиваем строго после эпиков: фильтр Ready без Type захватил бы и эпики.
+    with ThreadPoolExecutor(max_workers=1) as bg:
+        f_schema = bg.submit(debug_dump_db_schema) if WORKER_DEBUG else None
+
+        # 1) сначала обработать эпики (если есть)
+        try:
+            process_epics()
+        except Exception as e:
+            log.warning("process_epics failed: %s", e)
+        if f_schema:
+            f_schema.result()
 
-    # 2) затем выполнить готовые задачи
+    # 2) затем выполнить готовые задачи — параллельно, частоту держит _NOTION_BUCKET
     tasks = fetch_ready_tasks()
-    for i, t in enumerate(tasks, 1):
-        print(f"Task {i}/{len(tasks)}")
-        handle_task(t)
-        time.sleep(1.0)
+    with ThreadPoolExecutor(max_workers=TASK_CONCURRENCY) as ex:
+        list(ex.map(handle_task, tasks))
+    flush_updates()
 
-    print("Worker finished.")
+    log.info("Worker finished.")
 
 if __name__ == "__main__":
     main()